@@ -1,24 +1,110 @@
-from google.adk.agents import Agent, SequentialAgent
+from google.adk.agents import Agent, ParallelAgent, SequentialAgent
 from google.adk.models.google_llm import Gemini
 from google.adk.runners import InMemoryRunner
 from google.adk.tools import google_search
-from google.genai import types
-import os, asyncio
+from google.adk.tools.tool_context import ToolContext
+from google import genai
+from google.genai import errors, types
+import os, sys, asyncio, contextvars, functools, hashlib, importlib.util, json, logging, logging.handlers, math, tempfile
+import httpx
+from collections import Counter, defaultdict
 from pathlib import Path
-from google.adk.apps.app import App, EventsCompactionConfig
+from typing import Optional
+from pydantic import BaseModel, Field, ValidationError
+from google.adk.agents.run_config import RunConfig, StreamingMode
+from google.adk.apps.app import App
 from dotenv import load_dotenv
 
-load_dotenv()
-os.environ["GOOGLE_API_KEY"] = os.getenv("GOOGLE_API_KEY", "")
 
+@functools.lru_cache(maxsize=1)
+def ensure_env():
+    """Loads .env into the environment, once per process.
+
+    Variables that are already set, such as a real GOOGLE_API_KEY, take
+    precedence over the values in .env.
+    """
+    load_dotenv()
+
+
+# Model output is always streamed to stdout as it is generated. The progress
+# log (agent messages, tool calls) is buffered and written once at the end of
+# the run, unless NF_DEBUG=1, which writes it immediately and adds tool results.
+DEBUG = os.environ.get("NF_DEBUG") == "1"
+logger = logging.getLogger("nextflow_generator")
+
+# Name of the prompt file the current pipeline run generates from. Several
+# runs share stdout, so streamed chunks and log records are labelled with it.
+current_prompt = contextvars.ContextVar("current_prompt", default="")
+
+# Label of the last chunk written to stdout, shared by all concurrent runs.
+last_stream_label = None
+
+# Slow responses are hedged (see SharedGemini), so retries are only a short
+# fallback for genuine errors rather than the main defence against tail latency.
 retry_config=types.HttpRetryOptions(
-    attempts=5,  # Maximum retry attempts
-    exp_base=7,  # Delay multiplier
+    attempts=2,  # Maximum retry attempts
+    exp_base=2,  # Delay multiplier
     initial_delay=1, # Initial delay before first retry (in seconds)
     http_status_codes=[429, 500, 503, 504] # Retry on these HTTP errors
 )
 
-def create_path(path: str, content: str = None) -> str:
+# Domain preamble shared by every agent. It is prepended to each agent's own
+# instruction, which only carries its step-specific task, so every system
+# instruction starts with the same text.
+SHARED_SYSTEM_PREFIX = """You are part of a multi-agent pipeline that generates Nextflow (DSL2) projects.
+Each agent produces one piece of a standard nf-core style layout:
+
+PROJECT_NAME/
+├── main.nf
+├── nextflow.config
+└── modules/
+    └── PROCESS_NAME/
+        ├── main.nf
+        └── tests/
+            └── main.nf.test
+
+Naming rules:
+- PROJECT_NAME and PROCESS_NAME are snake_case.
+- The Nextflow process itself is named PROCESSNAME, i.e. PROCESS_NAME in uppercase.
+- When project metadata is given, read PROJECT_NAME and PROCESS_NAME from its
+  "PROJECT_NAME: <name>" and "PROCESS_NAME: <name>" lines and use them verbatim.
+
+When asked to create files, use the provided tool with paths relative to the
+current directory, and write complete, valid Nextflow code."""
+
+# Pipeline outputs are cached on disk, keyed by the prompt, the input files and
+# the pipeline itself (instructions and models), so unchanged inputs can be
+# replayed without calling the model again.
+CACHE_DIR = Path(".nfcache")
+
+# Paraphrased prompts reuse a cached run when their embeddings are this close.
+EMBEDDING_MODEL = "text-embedding-004"
+SEMANTIC_CACHE_THRESHOLD = 0.95
+EMBEDDING_INDEX = CACHE_DIR / "embeddings.json"
+
+# Serializes read-modify-write updates of the embedding index between
+# pipelines running concurrently in this process.
+embedding_index_lock = asyncio.Lock()
+
+# At most this many input file names are listed in the prompt; the rest are
+# only counted, so a large input_data/ does not inflate every agent's context.
+MAX_LISTED_INPUT_FILES = 50
+
+# Generated files are written through a 64 KiB buffer so a typical
+# module or config file is flushed in a single write syscall.
+WRITE_BUFFER_SIZE = 1 << 16
+
+# Files written by create_path during the current pipeline run, in order.
+generated_files = contextvars.ContextVar("generated_files", default=None)
+
+# Outcome of each agent's create_paths calls during the current pipeline run:
+# agent name -> True if every path it asked for was created.
+write_outcomes = contextvars.ContextVar("write_outcomes", default=None)
+
+# Agents that must write files for a run to be complete, and thus cacheable.
+FILE_WRITING_AGENTS = ("StructureAgent", "TestAgent", "ConfigAgent", "WorkflowAgent")
+
+async def create_path(path: str, content: str = None) -> str:
     """
     Creates a folder or file at the specified path. If content is provided, creates a file with that content.
     If content is None, creates a folder. Automatically creates parent directories as needed.
@@ -34,32 +120,457 @@ def create_path(path: str, content: str = None) -> str:
         path_obj = Path(path)
         if content is None:
             # Create folder
-            path_obj.mkdir(parents=True, exist_ok=True)
+            await asyncio.to_thread(path_obj.mkdir, parents=True, exist_ok=True)
+            record_generated_file(path, content)
             return f"Successfully created folder: {path}"
         else:
             # Create file with content
-            path_obj.parent.mkdir(parents=True, exist_ok=True)
-            with open(path_obj, 'w') as f:
-                f.write(content)
+            await asyncio.to_thread(write_file, path_obj, content)
+            record_generated_file(path, content)
             return f"Successfully created file: {path}"
     except Exception as e:
         return f"Error creating path: {str(e)}"
 
+class PathEntry(BaseModel):
+    """A folder or file to create with create_paths."""
+
+    path: str = Field(description="The path where the folder or file should be created")
+    content: Optional[str] = Field(
+        default=None, description="Content for file creation. If omitted, a folder is created instead."
+    )
+
+async def create_paths(entries: list[PathEntry], tool_context: ToolContext) -> str:
+    """
+    Creates several folders and files in one call. Use this to create everything a step needs at once.
+
+    Args:
+        entries: The paths to create. Entries with content become files; entries without content become folders.
+
+    Returns:
+        A JSON list with the result message for each entry, in order
+    """
+    results = []
+    for entry in entries:
+        # The model's arguments are not guaranteed to match the schema, so
+        # report a malformed entry instead of failing the whole call
+        try:
+            entry = PathEntry.model_validate(entry)
+        except ValidationError as e:
+            results.append(f"Error creating path: invalid entry {entry!r}: {e.errors()[0]['msg']}")
+            continue
+        if not entry.path:
+            results.append("Error creating path: entry has an empty path")
+            continue
+        results.append(await create_path(entry.path, entry.content))
+    record_write_outcome(tool_context.agent_name, results)
+    return json.dumps(results)
+
+def record_write_outcome(agent_name: str, results: list):
+    """Records whether an agent's create_paths call succeeded for the pipeline run in progress, if any."""
+    outcomes = write_outcomes.get()
+    if outcomes is not None:
+        succeeded = bool(results) and not any(result.startswith("Error") for result in results)
+        outcomes[agent_name] = outcomes.get(agent_name, True) and succeeded
+
+def is_complete_run(outcomes: dict) -> bool:
+    """Returns whether every file-writing agent created its paths without any errors."""
+    return all(outcomes.get(name) for name in FILE_WRITING_AGENTS)
+
+def write_file(path_obj: Path, content: str):
+    """Writes content to a file, creating its parent directories. Blocking; run it off the event loop."""
+    path_obj.parent.mkdir(parents=True, exist_ok=True)
+    with open(path_obj, 'w', buffering=WRITE_BUFFER_SIZE) as f:
+        f.write(content)
+
+def record_generated_file(path: str, content: str = None):
+    """Records a created path for the pipeline run in progress, if any."""
+    files = generated_files.get()
+    if files is not None:
+        files.append({"path": path, "content": content})
+
+def pipeline_fingerprint() -> str:
+    """Returns a hash of the instructions and models, so editing either invalidates cached runs."""
+    digest = hashlib.sha256()
+    for part in (
+        TODO_INSTRUCTION,
+        STRUCTURE_INSTRUCTION,
+        TEST_INSTRUCTION,
+        CONFIG_INSTRUCTION,
+        WORKFLOW_INSTRUCTION,
+        AGENT_MODEL,
+        templated_agent_model(),
+    ):
+        digest.update(part.encode() + b"\0")
+    return digest.hexdigest()
+
+def cache_key(prompt_content: str, input_files: list) -> str:
+    """Returns the cache key for a prompt and its (name, size) input file listing under the current pipeline."""
+    digest = hashlib.sha256(pipeline_fingerprint().encode() + b"\0" + prompt_content.encode())
+    for name, size in sorted(input_files):
+        digest.update(f"\0{name}\0{size}".encode())
+    return digest.hexdigest()
+
+def cache_lookup(key: str):
+    """Returns the cached pipeline output for key, or None on a miss."""
+    cache_file = CACHE_DIR / f"{key}.json"
+    try:
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_json_atomic(path: Path, data):
+    """Writes data as JSON through a temporary file, so readers never see a partial file. Blocking; run it off the event loop."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def cache_update(key: str, response: str, files: list):
+    """Stores the pipeline output for key."""
+    write_json_atomic(CACHE_DIR / f"{key}.json", {"response": response, "generated_files": files})
+
+# HTTP/2 lets concurrent agent requests share one multiplexed connection
+# instead of queueing behind each other on HTTP/1.1. httpx needs the optional
+# h2 package for it (pip install "httpx[http2]"), so it is used only if present.
+HTTP2 = importlib.util.find_spec("h2") is not None
+
+@functools.lru_cache(maxsize=1)
+def get_http_client() -> httpx.AsyncClient:
+    """Returns the pooled HTTP client that carries every Gemini request."""
+    return httpx.AsyncClient(
+        # Keep connections alive between agent calls instead of re-handshaking
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+        http2=HTTP2,
+        timeout=None,  # Same as google-genai's default; slow streams are hedged instead
+    )
+
+@functools.lru_cache(maxsize=1)
+def get_genai_client() -> genai.Client:
+    """Returns the GenAI client shared by every agent and direct API call."""
+    ensure_env()
+    # Passing our own httpx client also pins the transport: with only
+    # async_client_args, google-genai switches to aiohttp whenever that is
+    # installed and silently drops the pool and HTTP/2 settings.
+    return genai.Client(http_options=types.HttpOptions(
+        retry_options=retry_config,
+        httpx_async_client=get_http_client(),
+    ))
+
+async def close_genai_client():
+    """Closes the shared clients' connection pool. The next call to get_genai_client builds new ones."""
+    if get_genai_client.cache_info().currsize:
+        await get_genai_client().aio.aclose()
+        get_genai_client.cache_clear()
+    if get_http_client.cache_info().currsize:
+        await get_http_client().aclose()
+        get_http_client.cache_clear()
+
+async def embed_prompt(prompt_content: str):
+    """Returns the normalized embedding of a prompt, or None if it cannot be computed."""
+    try:
+        result = await get_genai_client().aio.models.embed_content(
+            model=EMBEDDING_MODEL,
+            contents=prompt_content,
+        )
+        values = result.embeddings[0].values
+    # API errors plus transport errors; the transport is always httpx because
+    # get_genai_client passes its own httpx client (see get_http_client)
+    except (errors.APIError, httpx.HTTPError) as e:
+        logger.warning("⚠️ Semantic cache skipped, could not embed prompt with %s: %s", EMBEDDING_MODEL, e)
+        return None
+    norm = math.sqrt(sum(v * v for v in values))
+    return [v / norm for v in values] if norm else None
+
+def load_embedding_index() -> list:
+    """Returns the stored prompt embeddings, or an empty list if there are none."""
+    try:
+        with open(EMBEDDING_INDEX, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+def semantic_cache_lookup(embedding: list, input_files: list):
+    """Returns the cache key of the most similar prompt run on the same input files, if close enough."""
+    files_key = cache_key("", input_files)
+    best_key, best_sim = None, SEMANTIC_CACHE_THRESHOLD
+    for entry in load_embedding_index():
+        if entry["input_files"] != files_key:
+            continue
+        sim = sum(a * b for a, b in zip(embedding, entry["embedding"]))
+        if sim >= best_sim:
+            best_key, best_sim = entry["key"], sim
+    return best_key
+
+def semantic_cache_update(embedding: list, input_files: list, key: str):
+    """Adds a prompt embedding to the index, pointing at the cache entry for key.
+
+    Not safe to run concurrently; callers hold embedding_index_lock.
+    """
+    index = load_embedding_index()
+    index.append({"key": key, "input_files": cache_key("", input_files), "embedding": embedding})
+    write_json_atomic(EMBEDDING_INDEX, index)
+
+def scan_input_files(input_data_dir: Path) -> list:
+    """Returns (name, size in bytes) for each non-hidden file in a directory. Blocking; run it off the event loop.
+
+    Symlinks to files are included with the size of their target, since input
+    data is often linked in rather than copied. Directories are skipped.
+    """
+    with os.scandir(input_data_dir) as entries:
+        return [
+            (entry.name, entry.stat().st_size)
+            for entry in entries
+            if entry.is_file() and not entry.name.startswith('.')
+        ]
+
+def format_size(size: int) -> str:
+    """Formats a byte count for display, e.g. 1.5 GB."""
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+def describe_input_files(input_files: list) -> str:
+    """Summarizes (name, size) input files by extension, followed by a bounded, sorted list of names and sizes."""
+    files = sorted(input_files)
+    counts = Counter(Path(name).suffix or "(no extension)" for name, _ in files)
+    summary = ", ".join(f"{ext}: {count}" for ext, count in sorted(counts.items()))
+    total = format_size(sum(size for _, size in files))
+    listed = [f"{name} ({format_size(size)})" for name, size in files[:MAX_LISTED_INPUT_FILES]]
+    if len(files) > MAX_LISTED_INPUT_FILES:
+        listed.append(f"... (+{len(files) - MAX_LISTED_INPUT_FILES} more)")
+    return f"{len(files)} files, {total} total ({summary})\n" + "\n".join(listed)
+
+def response_text(events) -> str:
+    """Returns the text of the last event in the run that carries any."""
+    for event in reversed(events):
+        if event.content and event.content.parts:
+            text = "".join(part.text or "" for part in event.content.parts)
+            if text:
+                return text
+    return ""
+
+USER_ID = "nextflow_user"
+
+
 async def ask(runner, question: str):
-    response = await runner.run_debug(question, verbose=True)
-    return response
+    """Runs the pipeline on a fresh session and returns its complete (non-partial) events.
 
+    The model output is streamed to stdout chunk by chunk, and each agent's
+    tool calls are logged as their events arrive.
+    """
+    # The request is also kept in state for the agents that run without the conversation history
+    session = await runner.session_service.create_session(
+        app_name=runner.app_name, user_id=USER_ID, state={"request": question}
+    )
+    message = types.Content(role="user", parts=[types.Part(text=question)])
+    run_config = RunConfig(streaming_mode=StreamingMode.SSE)
+
+    global last_stream_label
+    events = []
+    streamed = set()  # Authors whose current response has been written chunk by chunk
+    async for event in runner.run_async(
+        user_id=USER_ID, session_id=session.id, new_message=message, run_config=run_config
+    ):
+        text = "".join(part.text or "" for part in event.content.parts) if event.content and event.content.parts else ""
+        if event.partial:
+            if text:
+                # Parallel agents and concurrent runs interleave, so relabel on every switch
+                label = f"[{current_prompt.get()}] [{event.author}] "
+                if label != last_stream_label:
+                    sys.stdout.write("\n" + label)
+                    last_stream_label = label
+                streamed.add(event.author)
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            continue
+
+        # The final event repeats any streamed text, so only log it if nothing was streamed
+        events.append(event)
+        if text and event.author not in streamed:
+            logger.info("[%s] %s", event.author, text)
+        streamed.discard(event.author)
+        for call in event.get_function_calls():
+            logger.info("[%s] 🔧 %s", event.author, call.name)
+        for function_response in event.get_function_responses():
+            logger.debug("[%s]    %s", event.author, function_response.response)
+    return events
+
+
+class PromptFilter(logging.Filter):
+    """Tags each record with the prompt of the pipeline run that logged it."""
+
+    def filter(self, record):
+        record.prompt = current_prompt.get()
+        record.prompt_prefix = f"[{record.prompt}] " if record.prompt else ""
+        return True
+
+
+class PromptBufferingHandler(logging.Handler):
+    """Holds records per prompt until that prompt's run finishes. Errors are written immediately."""
+
+    def __init__(self, target: logging.Handler):
+        super().__init__()
+        self.target = target
+        self.buffers = defaultdict(list)
+
+    def emit(self, record):
+        if record.levelno >= logging.ERROR:
+            self.target.handle(record)
+        else:
+            self.buffers[record.prompt].append(record)
 
-def create_todo_agent():
-    """Creates and returns the TodoAgent for analyzing prompts and extracting metadata."""
-    return Agent(
-        name="TodoAgent",
-        model=Gemini(
-            model="gemini-2.5-flash-lite",
-            retry_options=retry_config
-        ),
-        description="Analyzes prompts and extracts project metadata for Nextflow workflow generation.",
-        instruction="""You are a project analyzer for Nextflow workflows. Based on the prompt and input data files, extract and provide:
+    def flush_prompt(self, prompt: str):
+        """Writes out the records held for one prompt."""
+        self.acquire()
+        try:
+            for record in self.buffers.pop(prompt, []):
+                self.target.handle(record)
+        finally:
+            self.release()
+
+    def flush(self):
+        for prompt in list(self.buffers):
+            self.flush_prompt(prompt)
+
+
+def configure_logging() -> logging.Handler:
+    """Attaches the pipeline's log handler and returns it so it can be flushed at the end of the run.
+
+    Records are held in memory per prompt and written when that prompt's
+    run finishes, unless NF_DEBUG=1, in which case they are written
+    immediately. Errors are never held back.
+    """
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter("%(prompt_prefix)s%(message)s"))
+    if DEBUG:
+        handler = stream_handler
+        logger.setLevel(logging.DEBUG)
+    else:
+        handler = PromptBufferingHandler(target=stream_handler)
+        logger.setLevel(logging.INFO)
+    handler.addFilter(PromptFilter())
+    logger.addHandler(handler)
+    return handler
+
+
+# Every agent runs on Gemini 2.5 Flash-Lite. There is no smaller, faster
+# Gemini tier below it for the templated agents to drop to (2.0 Flash-Lite is
+# an older generation, not a lighter one), so StructureAgent, TestAgent and
+# ConfigAgent only use a different model if one is named explicitly.
+AGENT_MODEL = "gemini-2.5-flash-lite"
+
+
+def templated_agent_model() -> str:
+    """Returns the model for the templated file-writing agents.
+
+    Set NF_TEMPLATED_AGENT_MODEL to run them on another model, e.g. to
+    measure a newer, lighter one against AGENT_MODEL.
+    """
+    return os.getenv("NF_TEMPLATED_AGENT_MODEL", "").strip() or AGENT_MODEL
+
+
+# Upper bound on Gemini requests in flight across all agents and pipelines,
+# hedged duplicates included.
+MAX_INFLIGHT_REQUESTS = 8
+gemini_slots = asyncio.Semaphore(MAX_INFLIGHT_REQUESTS)
+
+# If a streamed request has not produced its first chunk after this many
+# seconds (roughly the observed p90 time to first chunk), a duplicate is sent
+# and the first to answer wins. Requests whose first response is the whole
+# generation are never hedged, since any deadline short enough to help would
+# duplicate nearly every call: non-streamed requests, and requests that
+# declare tools, because Gemini streams a function call (here a create_paths
+# call carrying whole files) as one chunk once it is fully generated.
+HEDGE_DELAY = 2.0
+
+
+async def discard_response(task: asyncio.Task, responses):
+    """Cancels a pending first-response task and closes its response stream."""
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    await responses.aclose()
+
+
+class SharedGemini(Gemini):
+    """Gemini model that sends every request through the shared GenAI client.
+
+    By default each Gemini instance builds its own client and connection pool.
+    Routing all agents through one client lets concurrent requests reuse its
+    connections, and the shared semaphore caps how many are in flight at once.
+    Streamed, tool-free requests slower than HEDGE_DELAY to respond are hedged
+    with a duplicate.
+    """
+
+    @property
+    def api_client(self) -> genai.Client:
+        return get_genai_client()
+
+    async def generate_content_async(self, llm_request, stream: bool = False):
+        if not stream or (llm_request.config and llm_request.config.tools):
+            async for llm_response in self.slotted_responses(llm_request, stream):
+                yield llm_response
+            return
+
+        first, responses = await self.hedged_first_response(llm_request, stream)
+        try:
+            for llm_response in first:
+                yield llm_response
+            async for llm_response in responses:
+                yield llm_response
+        finally:
+            await responses.aclose()
+
+    async def slotted_responses(self, llm_request, stream: bool):
+        """Yields the responses to a request while holding one of the in-flight slots."""
+        async with gemini_slots:
+            async for llm_response in super().generate_content_async(llm_request, stream=stream):
+                yield llm_response
+
+    async def hedged_first_response(self, llm_request, stream: bool):
+        """Returns the first response and the rest of its stream, from whichever of the request or its hedge answers first.
+
+        The first response is returned as a list, which is empty if the winning stream was empty.
+        """
+        # Gemini mutates the request while sending it, so the hedge gets its own copy
+        hedge_request = llm_request.model_copy(deep=True)
+        primary = self.slotted_responses(llm_request, stream)
+        racers = {asyncio.ensure_future(anext(primary)): primary}
+        try:
+            done, _ = await asyncio.wait(racers, timeout=HEDGE_DELAY)
+            if not done:
+                hedge = self.slotted_responses(hedge_request, stream)
+                racers[asyncio.ensure_future(anext(hedge))] = hedge
+
+            error = None
+            while racers:
+                done, _ = await asyncio.wait(racers, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    responses = racers.pop(task)
+                    if task.exception() is None:
+                        return [task.result()], responses
+                    if isinstance(task.exception(), StopAsyncIteration):
+                        return [], responses
+                    error = task.exception()
+            raise error
+        finally:
+            # Losers, and every racer if the caller was cancelled mid-race
+            for task, responses in racers.items():
+                await discard_response(task, responses)
+
+
+# Instructions for each agent: the shared preamble followed by the agent's
+# step-specific task. They are module constants so they are built once at
+# import and can be compared or hashed directly.
+TODO_INSTRUCTION = SHARED_SYSTEM_PREFIX + """
+
+Analyze the request. Based on the prompt and input data files, extract and provide:
 
 1. PROJECT_NAME: A suitable name for the Nextflow project (snake_case, descriptive)
 2. PROCESS_NAME: The main process name for the Nextflow module (snake_case)
@@ -74,23 +585,19 @@ TODO LIST:
 2. <todo item 2>
 ...
 
-Be specific and extract these names from the context provided.""",
-        output_key="project_metadata",
-    )
+Input files are listed with their sizes. Take them into account in the plan,
+e.g. very large inputs (several GB) may need to be split or sharded.
 
+Be specific and extract these names from the context provided."""
 
-def create_structure_agent():
-    """Creates and returns the StructureAgent for creating project structure and main.nf."""
-    return Agent(
-        name="StructureAgent",
-        model=Gemini(
-            model="gemini-2.5-flash-lite",
-            retry_options=retry_config
-        ),
-        description="Creates Nextflow project structure with modules folder and main.nf.",
-        instruction="""Based on the project metadata: {project_metadata}
+STRUCTURE_INSTRUCTION = SHARED_SYSTEM_PREFIX + """
+
+Original request:
+{request}
 
-Extract the PROJECT_NAME and PROCESS_NAME, then create:
+Based on the project metadata: {project_metadata}
+
+Create:
 1. Folder: PROJECT_NAME/modules/PROCESS_NAME/
 2. File: PROJECT_NAME/modules/PROCESS_NAME/main.nf with:
    - process PROCESSNAME (uppercase)
@@ -100,25 +607,17 @@ Extract the PROJECT_NAME and PROCESS_NAME, then create:
    - output block
    - script block
 
-Use create_path tool. After creating, provide a summary of the main.nf content.""",
-        tools=[create_path],
-        output_key="main_nf_summary",
-    )
+Emit a single create_paths call listing all paths to create. After creating, provide a summary of the main.nf content."""
 
+TEST_INSTRUCTION = SHARED_SYSTEM_PREFIX + """
 
-def create_test_agent():
-    """Creates and returns the TestAgent for creating test files."""
-    return Agent(
-        name="TestAgent",
-        model=Gemini(
-            model="gemini-2.5-flash-lite",
-            retry_options=retry_config
-        ),
-        description="Creates Nextflow test file for the module.",
-        instruction="""Based on the project metadata: {project_metadata}
+Original request:
+{request}
+
+Based on the project metadata: {project_metadata}
 And the main.nf summary: {main_nf_summary}
 
-Extract PROJECT_NAME and PROCESS_NAME, then create:
+Create:
 1. Folder: PROJECT_NAME/modules/PROCESS_NAME/tests/
 2. File: PROJECT_NAME/modules/PROCESS_NAME/tests/main.nf.test with:
    - name field
@@ -126,73 +625,147 @@ Extract PROJECT_NAME and PROCESS_NAME, then create:
    - PROCESSNAME reference
    - Multiple test() blocks with setup {}, when {}, then {}
 
-Use create_path tool. After creating, provide a summary of the test file.""",
-        tools=[create_path],
+Emit a single create_paths call listing all paths to create. After creating, provide a summary of the test file."""
+
+CONFIG_INSTRUCTION = SHARED_SYSTEM_PREFIX + """
+
+Original request:
+{request}
+
+Based on the project metadata: {project_metadata}
+
+Create:
+File: PROJECT_NAME/nextflow.config with:
+- profiles block (standard, docker, conda, etc.)
+- params block with default parameters
+- process configuration
+
+Emit a single create_paths call listing all paths to create.
+IMPORTANT: After creating the file, you MUST provide a text summary of the config content. This summary is required for the next step. Do not stop after the tool call."""
+
+WORKFLOW_INSTRUCTION = SHARED_SYSTEM_PREFIX + """
+
+Original request:
+{request}
+
+Based on all previous outputs:
+Project metadata: {project_metadata}
+Main.nf: {main_nf_summary}
+Tests: {test_summary}
+Config: {config_summary}
+
+Create:
+File: PROJECT_NAME/main.nf with:
+- include statement for the module
+- workflow block that uses the process
+- input channel creation
+- process invocation
+
+Emit a single create_paths call listing all paths to create. After creating, provide a complete summary of the entire project."""
+
+
+@functools.lru_cache(maxsize=1)
+def create_todo_agent():
+    """Creates and returns the TodoAgent for analyzing prompts and extracting metadata."""
+    ensure_env()
+    return Agent(
+        name="TodoAgent",
+        model=SharedGemini(
+            model=AGENT_MODEL,
+            retry_options=retry_config
+        ),
+        description="Analyzes prompts and extracts project metadata for Nextflow workflow generation.",
+        instruction=TODO_INSTRUCTION,
+        output_key="project_metadata",
+    )
+
+
+# Every agent after the TodoAgent reads what it needs from session state: the
+# original request via {request} and earlier results via their {output_key}
+# placeholders. It is run with include_contents="none" because earlier agents'
+# create_paths calls carry whole generated files as arguments and would
+# otherwise be replayed into each later agent's prompt.
+
+
+@functools.lru_cache(maxsize=1)
+def create_structure_agent():
+    """Creates and returns the StructureAgent for creating project structure and main.nf."""
+    ensure_env()
+    return Agent(
+        name="StructureAgent",
+        model=SharedGemini(
+            model=templated_agent_model(),
+            retry_options=retry_config
+        ),
+        description="Creates Nextflow project structure with modules folder and main.nf.",
+        instruction=STRUCTURE_INSTRUCTION,
+        tools=[create_paths],
+        include_contents="none",
+        output_key="main_nf_summary",
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def create_test_agent():
+    """Creates and returns the TestAgent for creating test files."""
+    ensure_env()
+    return Agent(
+        name="TestAgent",
+        model=SharedGemini(
+            model=templated_agent_model(),
+            retry_options=retry_config
+        ),
+        description="Creates Nextflow test file for the module.",
+        instruction=TEST_INSTRUCTION,
+        tools=[create_paths],
+        include_contents="none",
         output_key="test_summary",
     )
 
 
+@functools.lru_cache(maxsize=1)
 def create_config_agent():
     """Creates and returns the ConfigAgent for creating nextflow.config."""
+    ensure_env()
     return Agent(
         name="ConfigAgent",
-        model=Gemini(
-            model="gemini-2.5-flash-lite",
+        model=SharedGemini(
+            model=templated_agent_model(),
             retry_options=retry_config
         ),
         description="Creates nextflow.config with profiles and default params.",
-        instruction="""Based on the project metadata: {project_metadata}
-
-Extract PROJECT_NAME and create:
-File: PROJECT_NAME/nextflow.config with:
-- profiles block (standard, docker, conda, etc.)
-- params block with default parameters
-- process configuration
-
-Use create_path tool. 
-IMPORTANT: After creating the file, you MUST provide a text summary of the config content. This summary is required for the next step. Do not stop after the tool call.""",
-        tools=[create_path],
+        instruction=CONFIG_INSTRUCTION,
+        tools=[create_paths],
+        include_contents="none",
         output_key="config_summary",
     )
 
 
+@functools.lru_cache(maxsize=1)
 def create_workflow_agent():
     """Creates and returns the WorkflowAgent for creating the main workflow file."""
+    ensure_env()
     return Agent(
         name="WorkflowAgent",
-        model=Gemini(
-            model="gemini-2.5-flash-lite",
+        model=SharedGemini(
+            model=AGENT_MODEL,
             retry_options=retry_config
         ),
         description="Creates main workflow file.",
-        instruction="""Based on all previous outputs:
-Project metadata: {project_metadata}
-Main.nf: {main_nf_summary}
-Tests: {test_summary}
-Config: {config_summary}
-
-Extract PROJECT_NAME and PROCESS_NAME, then create:
-File: PROJECT_NAME/main.nf with:
-- include statement for the module
-- workflow block that uses the process
-- input channel creation
-- process invocation
-
-Use create_path tool. After creating, provide a complete summary of the entire project.""",
-        tools=[create_path],
+        instruction=WORKFLOW_INSTRUCTION,
+        tools=[create_paths],
+        include_contents="none",
         output_key="workflow_summary",
     )
 
 
-def main():
-    # Read prompt.txt and input data files
-    base_dir = Path(__file__).parent
-    input_data_dir = base_dir.parent / 'input_data'
-    input_files = os.listdir(input_data_dir)
-    prompt_file = base_dir.parent / 'prompt.txt'
-    with open(prompt_file, 'r') as pf:
-        prompt_content = pf.read()
-    
+@functools.lru_cache(maxsize=1)
+def get_runner() -> InMemoryRunner:
+    """Builds the agent pipeline and its runner once per process and returns the shared runner.
+
+    Each run gets its own session (see ask), so the runner can be reused
+    across runs and concurrent requests without sharing state.
+    """
     # Create all agents using modular functions
     todo_agent = create_todo_agent()
     structure_agent = create_structure_agent()
@@ -200,38 +773,153 @@ def main():
     config_agent = create_config_agent()
     workflow_agent = create_workflow_agent()
 
-    print("✅ All agents created.")
+    logger.info("✅ All agents created.")
+
+    # TestAgent and ConfigAgent only depend on the outputs of earlier steps,
+    # so they can run side by side before the WorkflowAgent assembles them.
+    test_and_config_agent = ParallelAgent(
+        name="TestAndConfigAgent",
+        sub_agents=[test_agent, config_agent],
+    )
 
     # Create Sequential Agent Pipeline
     root_agent = SequentialAgent(
         name="NextflowGeneratorPipeline",
-        sub_agents=[todo_agent, structure_agent, test_agent, config_agent, workflow_agent],
+        sub_agents=[todo_agent, structure_agent, test_and_config_agent, workflow_agent],
     )
 
-    print("✅ Sequential Agent Pipeline created.")
+    logger.info("✅ Sequential Agent Pipeline created.")
 
-    # Create App with session management and context compaction
+    # Create App with session management. There is no events compaction: it
+    # runs between invocations, and every run gets a fresh, single-invocation session.
     app = App(
         name="NextflowGeneratorApp",
         root_agent=root_agent,
-        events_compaction_config=EventsCompactionConfig(
-            compaction_interval=5,
-            overlap_size=2
-        )
     )
     
     # Create Runner
-    runner = InMemoryRunner(app=app)
+    return InMemoryRunner(app=app)
+
+
+def read_text(path: Path) -> str:
+    """Reads a text file. Blocking; run it off the event loop."""
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def read_concurrency() -> int:
+    """Returns NF_CONCURRENCY, the number of projects to generate at once (default 4)."""
+    raw = os.getenv("NF_CONCURRENCY", "4")
+    try:
+        concurrency = int(raw)
+    except ValueError:
+        concurrency = 0
+    if concurrency < 1:
+        raise SystemExit(f"NF_CONCURRENCY must be a positive integer, got {raw!r}")
+    return concurrency
+
+
+def find_prompt_files(project_dir: Path) -> list:
+    """Returns the prompts to generate projects from: prompts/*.txt if there are any, otherwise prompt.txt."""
+    prompts_dir = project_dir / 'prompts'
+    prompt_files = sorted(prompts_dir.glob('*.txt')) if prompts_dir.is_dir() else []
+    return prompt_files or [project_dir / 'prompt.txt']
+
+
+async def amain():
+    # Read the prompts and input data files without blocking the event loop
+    base_dir = Path(__file__).parent
+    input_data_dir = base_dir.parent / 'input_data'
+    input_files = await asyncio.to_thread(scan_input_files, input_data_dir)
+    prompt_files = await asyncio.to_thread(find_prompt_files, base_dir.parent)
+
+    # Generate one project per prompt, a bounded number at a time. The runs
+    # share the agents and HTTP client but each gets its own session.
+    concurrency = asyncio.Semaphore(read_concurrency())
+
+    async def generate(prompt_file: Path):
+        async with concurrency:
+            prompt_content = await asyncio.to_thread(read_text, prompt_file)
+            await run_pipeline(prompt_file.name, prompt_content, input_files)
+
+    results = await asyncio.gather(*(generate(p) for p in prompt_files), return_exceptions=True)
+    for prompt_file, result in zip(prompt_files, results):
+        if isinstance(result, Exception):
+            logger.error("❌ Generation from %s failed: %s", prompt_file.name, result)
+
+
+async def run_pipeline(name: str, prompt_content: str, input_files: list):
+    """Generates one Nextflow project from a prompt, replaying a cached run when possible."""
+    current_prompt.set(name)
+    # Replay a previous run with the same prompt and input files
+    key = cache_key(prompt_content, input_files)
+    cached = await asyncio.to_thread(cache_lookup, key)
+    embedding = None
+    if cached is None:
+        # Fall back to a run whose prompt was a close paraphrase of this one
+        embedding = await embed_prompt(prompt_content)
+        if embedding is not None:
+            similar_key = await asyncio.to_thread(semantic_cache_lookup, embedding, input_files)
+            if similar_key is not None:
+                cached = await asyncio.to_thread(cache_lookup, similar_key)
+    if cached is not None:
+        for entry in cached["generated_files"]:
+            logger.info(await create_path(entry["path"], entry["content"]))
+        print_summary(name, cached["response"], cached=True)
+        return
     
+    runner = get_runner()
+
     # Run the pipeline
-    query = f"Generate Nextflow workflow based on:\n\nPrompt: {prompt_content}\n\nInput files: {input_files}"
-    response = asyncio.run(ask(runner, query))
-    
-    print("\n" + "="*60)
-    print("NEXTFLOW PROJECT GENERATION COMPLETE")
-    print("="*60)
-    print(response)
-    print("\n✅ Nextflow project generation completed!")
+    query = f"Generate Nextflow workflow based on:\n\nPrompt: {prompt_content}\n\nInput files: {describe_input_files(input_files)}"
+    files = []
+    generated_files.set(files)
+    outcomes = {}
+    write_outcomes.set(outcomes)
+    response = response_text(await ask(runner, query))
+    # Only cache complete runs, so a broken project is never replayed
+    if is_complete_run(outcomes):
+        await asyncio.to_thread(cache_update, key, response, files)
+        if embedding is not None:
+            async with embedding_index_lock:
+                await asyncio.to_thread(semantic_cache_update, embedding, input_files, key)
+    else:
+        missing = [agent for agent in FILE_WRITING_AGENTS if not outcomes.get(agent)]
+        logger.warning("⚠️ Not caching: no complete file output from %s", ", ".join(missing))
+
+    print_summary(name, response)
+
+
+async def run():
+    try:
+        await amain()
+    finally:
+        # The pooled connections belong to this event loop; close them before it goes away
+        await close_genai_client()
+
+
+def main():
+    ensure_env()
+    log_handler = configure_logging()
+    try:
+        asyncio.run(run())
+    finally:
+        log_handler.flush()
+
+
+def print_summary(name: str, response: str, cached: bool = False):
+    # Write out this prompt's buffered progress log first so it precedes the
+    # summary; other prompts still running keep theirs until they finish
+    for handler in logger.handlers:
+        if isinstance(handler, PromptBufferingHandler):
+            handler.flush_prompt(name)
+    sys.stdout.write(
+        "\n" + "="*60 + "\n"
+        + f"NEXTFLOW PROJECT GENERATION COMPLETE: {name}" + (" (cached)" if cached else "") + "\n"
+        + "="*60 + "\n"
+        + response + "\n"
+        + "\n✅ Nextflow project generation completed!\n"
+    )
 
 
 